@@ -1,222 +1,295 @@
+import asyncio
+import hashlib
 import os
+import tempfile
 import pypandoc
-import pandas as pd
-import requests
 
-from bs4 import BeautifulSoup
+import aiofiles
+import diskcache
+import httpx
+import jinja2
+
+from markupsafe import Markup
+from selectolax.lexbor import LexborHTMLParser
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
 
-from requests.adapters import HTTPAdapter, Retry
 
+MAX_CONCURRENT_REQUESTS = 64
 
-def flatten(t):
-    return [item for sublist in t for item in sublist if item]
+OUTPUT_DIR = "output"
 
+MOVIE_CARDS_SELECTOR = "div.showtimes-list-holder div.movie-card-theater"
+HOURS_SELECTOR = 'div.showtimes-anchor span.showtimes-hour-item-value, div.showtimes-anchor span.showtimes-hours-item-value'
 
-def to_html(md):
-    return pypandoc.convert_text(md, 'html5', format = 'md')
+CINEMAS_BY_CODE = {
+    "C0026": "bercy",
+    "C0144": "nation",
+    "C2954": "bibliothèque",
+    "C0020": "filmothèque"
+    }
 
+PAGES_TO_SCRAPE = [1, 2]
 
-def normalise_path(filepath):
-    problem_chars = ['"', ":", "<", ">", "|", "*", "?", "\r", "\n"]
-    
-    for problem_char in problem_chars:
-        filepath = filepath.replace(problem_char, "")
+DAYS_BY_INDEX = {
+    0: "Lundi",
+    1: "Mardi",
+    2: "Mercredi",
+    3: "Jeudi",
+    4: "Vendredi",
+    5: "Samedi",
+    6: "Dimanche"
+    }
 
-    return filepath
+template_cache_dir = os.path.join(tempfile.gettempdir(), "cinema_jinja_cache")
+os.makedirs(template_cache_dir, exist_ok = True)
 
+template_env = jinja2.Environment(
+    loader = jinja2.FileSystemLoader("programs"),
+    autoescape = jinja2.select_autoescape(["html", "xml"]),
+    bytecode_cache = jinja2.FileSystemBytecodeCache(template_cache_dir),
+    auto_reload = False
+    )
 
-def create_url(cinema, date, page):
-    page_code = "" if page == 1 else "?page={page}".format(page = page)
-    url = "https://www.allocine.fr/seance/salle_gen_csalle={cinema}.html#shwt_date={date}{page_code}".format(cinema = cinema, date = date.strftime('%Y-%m-%d'), page_code = page_code)
+get_template = lru_cache(maxsize = 8)(template_env.get_template)
 
-    return url
+render_cache = diskcache.Cache(".render_cache")
 
+scrape_cache = diskcache.Cache(".allocine_cache")
 
-def get_url(url, s):
-    response = s.get(url)
 
-    if response.ok:
-        results = BeautifulSoup(response.text, "lxml")
-        return results
-    else:
-        return
+def render_cache_key(*parts):
+    return hashlib.blake2b(repr(parts).encode(), digest_size = 16).hexdigest()
 
 
-def parse_hour(hour):
-    singular = hour.find('span', class_='showtimes-hour-item-value')
-    plural = hour.find('span', class_='showtimes-hours-item-value')
+def flatten(t):
+    return [item for sublist in t for item in sublist if item]
 
-    if singular:
-        return singular.text.strip()
-    elif plural:
-        return plural.text.strip()
-    else:
-        return
 
+def to_html(md):
+    return pypandoc.convert_text(md, 'html5', format = 'md')
 
-def parse_div(div, s):
-    film_name = div.find('a', class_='meta-title-link').text
-    synopsis = div.find('div', class_='synopsis').text.strip()
-    showtimes_div = div.find('div', class_='showtimes-anchor')
-    hours = showtimes_div.find_all('div', class_='showtimes-hour-block')
 
-    img_tag = div.find('img', class_='thumbnail-img')
-    thumbnail_url = img_tag.get('data-src', img_tag.get('src'))
+PATH_TRANSLATION = str.maketrans({problem_char: None for problem_char in '":<>|*?/\r\n'})
 
-    filepath = os.path.join("output", normalise_path(film_name) + ".jpg")
-    if not os.path.isfile(filepath):
-        response = s.get(thumbnail_url)
-        with open(filepath, 'wb') as f:
-            f.write(response.content)
 
-    date_tag = div.find('span', class_='date')
+@lru_cache(maxsize = None)
+def normalise_path(filepath):
+    return filepath.translate(PATH_TRANSLATION).strip()
+
+
+def create_url(cinema, date_str, page):
+    page_code = "" if page == 1 else "?page={page}".format(page = page)
+    url = "https://www.allocine.fr/seance/salle_gen_csalle={cinema}.html#shwt_date={date}{page_code}".format(cinema = cinema, date = date_str, page_code = page_code)
+
+    return url
+
+
+async def fetch_url_content(url, client, semaphore):
+    async with semaphore:
+        for attempt in range(20):
+            try:
+                response = await client.get(url)
+            except httpx.TransportError:
+                await asyncio.sleep(min(0.1 * 2 ** attempt, 10))
+                continue
+            if response.is_success:
+                return response.text
+            elif response.status_code in (500, 502, 503, 504):
+                await asyncio.sleep(min(0.1 * 2 ** attempt, 10))
+            else:
+                return
+
+
+async def download_image(url, filepath, client, semaphore):
+    temp_filepath = filepath + ".part"
+    async with semaphore:
+        try:
+            async with client.stream("GET", url) as response:
+                if response.is_success:
+                    async with aiofiles.open(temp_filepath, 'wb') as f:
+                        async for chunk in response.aiter_bytes(1 << 16):
+                            await f.write(chunk)
+                    os.replace(temp_filepath, filepath)
+                    return True
+        except httpx.HTTPError:
+            if os.path.isfile(temp_filepath):
+                os.remove(temp_filepath)
+    return False
+
+
+def parse_movie_div(node):
+    film_name = node.css_first('a.meta-title-link').text()
+    synopsis = node.css_first('div.synopsis').text(strip = True)
+    hours = node.css(HOURS_SELECTOR)
+
+    img_tag = node.css_first('img.thumbnail-img')
+    thumbnail_url = img_tag.attributes.get('data-src') or img_tag.attributes.get('src')
+
+    date_tag = node.css_first('span.date')
     if date_tag:
-        release_date = date_tag.text
+        release_date = date_tag.text()
     else:
         release_date = ""
 
     try:
-        showtimes = [parse_hour(hour) for hour in hours]
-        seances = [(film_name, release_date, synopsis, showtime) for showtime in showtimes]
+        showtimes = [hour.text(strip = True) for hour in hours]
+        seances = [(film_name, release_date, synopsis, showtime, thumbnail_url) for showtime in showtimes]
         return seances
     except:
         return
 
 
-def parse_results(result, s):
-    content = result.find("div", {"class": "showtimes-list-holder"})
-    seances = content.find_all("div", {"class": "card entity-card entity-card-list movie-card-theater cf hred"})
+def parse_page_results(html):
+    if not html:
+        return
+    tree = LexborHTMLParser(html)
+    nodes = tree.css(MOVIE_CARDS_SELECTOR)
     try:
-        seances = flatten([parse_div(seance, s) for seance in seances])
-        return seances
+        seances = [parse_movie_div(node) for node in nodes]
+        return flatten(seances)
     except:
         return
 
 
-def scrap_page(cinema, day, page, s):
-    url = create_url(cinema, day, page)
-    result = get_url(url, s)
-    if result:
-        seances = parse_results(result, s)
-        return seances
+def render_film_html(film, info):
+    seances = Markup('\n'.join([
+        Markup("{cinema} {heures}<br>").format(cinema = cinema, heures = "/".join(sorted(heures)))
+        for cinema, heures in sorted(info["by_cinema"].items())
+        ]))
 
+    key = render_cache_key(film, seances, info["synopsis"], info["release_date"])
+    if key in render_cache:
+        return key, render_cache[key]
 
-def build_seances(cinema, results):
-    results = results[results["cinema"] == cinema]
-    heures = sorted(results.heure.unique())
-    return "/".join(heures)
+    template = get_template("film_section.html")
+    html_chunk = template.render(film = film, film_path = normalise_path(film), jour_sortie = info["release_date"], seances = seances, synopsis = info["synopsis"])
 
+    render_cache[key] = html_chunk
+    return key, html_chunk
 
-def generate_html_seance(results):
-    cinemas = results.cinema.unique()
-    html_chunk = '\n'.join(["{cinema} {seances}<br>".format(cinema = cinema, seances = build_seances(cinema, results)) for cinema in cinemas])
-    return html_chunk
 
+def render_day_html(jour, films):
+    film_chunks = [render_film_html(film, info) for film, info in sorted(films.items())]
 
-def generate_html_film(film, results):
-    results = results[results["film"] == film]
-    synopsis = results.synopsis.unique()[0]
-    jour_sortie = results.jour_sortie.unique()[0]
+    key = render_cache_key(jour, *[film_key for film_key, film_html in film_chunks])
+    if key in render_cache:
+        return render_cache[key]
 
-    seances = generate_html_seance(results)
+    bloc = Markup("\n".join([film_html for film_key, film_html in film_chunks]))
 
-    html_chunk = """
-<details>
-<summary>{film}<br><small>{seances}</small></summary>
-<div class="container">
-<div class="image"><img src=\"{film_path}.jpg\" width=\"160\"></div>
-<div class="text"><small>{jour_sortie}</small> <br> {synopsis}</div>
-<br>
-</details>
-""".format(film = film, film_path = normalise_path(film), jour_sortie = jour_sortie, seances = seances, synopsis = synopsis)
+    template = get_template("day_section.html")
+    html_chunk = template.render(jour = jour, bloc = bloc)
 
+    render_cache[key] = html_chunk
     return html_chunk
 
 
-def generate_html_jour(jour, results):
-    results = results[results["jour"] == jour]
-
-    bloc = "\n".join([generate_html_film(film, results) for film in sorted(results.film.unique())])
-
-    html_chunk = "<details>\n<summary>{jour}</summary><br>{bloc}<br></details><br>".format(jour = jour, bloc = bloc)
-
-    return html_chunk
-
-
-def read_file(path):
-    with open(path, encoding="utf-8") as f:
-        content = f.read()
-
-    return content
-
-
-def main():
-    s = requests.Session()
-
-    retries = Retry(
-        total = 20,
-        backoff_factor = 0.1,
-        status_forcelist = [ 500, 502, 503, 504]
-        )
-
-    s.mount('https://', HTTPAdapter(max_retries=retries))
-
+async def main():
     today = datetime.today()
     dates = [
         (today +  timedelta(days = k))
         for k in range(7)
         ]
 
-    cinemas_by_code = {
-        "C0026": "bercy",
-        "C0144": "nation",
-        "C2954": "bibliothèque",
-        "C0020": "filmothèque"
-        }
-
-    pages = [1, 2]
+    dates_str = {date: date.strftime('%Y-%m-%d') for date in dates}
 
-    results = {
-      (cinema, date, page): scrap_page(cinema, date, page, s)
-      for cinema in cinemas_by_code
+    keys = [
+      (cinema, date, page)
+      for cinema in CINEMAS_BY_CODE
       for date in dates
-      for page in pages
-      }
-
-    results = {key: value for key, value in results.items() if value}
-
-    days_by_index = {
-        0: "Lundi",
-        1: "Mardi",
-        2: "Mercredi",
-        3: "Jeudi",
-        4: "Vendredi",
-        5: "Samedi",
-        6: "Dimanche"
+      for page in PAGES_TO_SCRAPE
+      ]
+
+    urls_by_key = {
+        (cinema, date, page): create_url(cinema, dates_str[date], page)
+        for (cinema, date, page) in keys
         }
 
-    index_by_day = {day: index for index, day in days_by_index.items()}
-    today = datetime.today().weekday()
+    existing_images = {
+        entry.name
+        for entry in os.scandir(OUTPUT_DIR)
+        if entry.is_file() and entry.name.endswith(".jpg")
+        }
 
-    results = [
-      (cinemas_by_code[cinema], days_by_index[date.weekday()], film_name, release_date, synopsis, showtime)
-      for (cinema, date, page), seances in results.items()
-      for (film_name, release_date, synopsis, showtime) in seances
-      ]
+    seances_by_key = {}
+    missing_keys = []
+    for key in keys:
+        cinema, date, page = key
+        cache_key = (cinema, dates_str[date], page)
+        if cache_key in scrape_cache:
+            seances_by_key[key] = scrape_cache[cache_key]
+        else:
+            missing_keys.append((key, cache_key))
+
+    transport = httpx.AsyncHTTPTransport(
+        http2 = True,
+        retries = 3,
+        limits = httpx.Limits(max_connections = 64, max_keepalive_connections = 32)
+        )
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async with httpx.AsyncClient(transport = transport, timeout = 10.0, follow_redirects = True) as client:
+        htmls = await asyncio.gather(*[
+            fetch_url_content(urls_by_key[key], client, semaphore)
+            for key, cache_key in missing_keys
+            ])
+
+        with ProcessPoolExecutor() as executor:
+            parsed = list(executor.map(parse_page_results, htmls, chunksize = 4))
+
+        for (key, cache_key), page_seances in zip(missing_keys, parsed):
+            seances_by_key[key] = page_seances
+            if page_seances:
+                expire = 3600 if (key[1] - today).days <= 1 else 24 * 3600
+                scrape_cache.set(cache_key, page_seances, expire = expire)
+
+        thumbnails_by_filename = {}
+        seen_thumbnail_urls = set()
+        for page_seances in seances_by_key.values():
+            if not page_seances:
+                continue
+            for film_name, release_date, synopsis, showtime, thumbnail_url in page_seances:
+                if not thumbnail_url:
+                    continue
+                image_filename = normalise_path(film_name) + ".jpg"
+                if image_filename in existing_images or thumbnail_url in seen_thumbnail_urls:
+                    continue
+                thumbnails_by_filename[image_filename] = thumbnail_url
+                seen_thumbnail_urls.add(thumbnail_url)
+
+        downloaded = await asyncio.gather(*[
+            download_image(thumbnail_url, os.path.join(OUTPUT_DIR, image_filename), client, semaphore)
+            for image_filename, thumbnail_url in thumbnails_by_filename.items()
+            ])
+        existing_images.update(image_filename for image_filename, success in zip(thumbnails_by_filename, downloaded) if success)
+
+    data = {}
+    for (cinema, date, page), page_seances in seances_by_key.items():
+        if not page_seances:
+            continue
+        cinema_name = CINEMAS_BY_CODE[cinema]
+        day_name = DAYS_BY_INDEX[date.weekday()]
+        for film_name, release_date, synopsis, showtime, thumbnail_url in page_seances:
+            film = data.setdefault(day_name, {}).setdefault(film_name, {
+                "synopsis": synopsis,
+                "release_date": release_date,
+                "by_cinema": defaultdict(set)
+                })
+            film["by_cinema"][cinema_name].add(showtime)
+
+    index_by_day = {day: index for index, day in DAYS_BY_INDEX.items()}
+    today = datetime.today().weekday()
 
-    results = pd.DataFrame(results, columns = ("cinema", "jour", "film", "jour_sortie", "synopsis", "heure"))
-    sorted_days = sorted(results.jour.unique(), key = lambda jour: (index_by_day[jour] - today) % 7)
-    html_chunks = [generate_html_jour(jour, results) for jour in sorted_days]
+    sorted_days = sorted(data, key = lambda jour: (index_by_day[jour] - today) % 7)
+    html_chunks = [render_day_html(jour, data[jour]) for jour in sorted_days]
 
-    text = \
-        read_file("programs/header.html") \
-        + "\n".join(html_chunks) \
-        + read_file("programs/footer.html")
+    template = get_template("index.html")
 
-    with open("output/index.html", "w") as f:
-        f.write(text)
+    with open(os.path.join(OUTPUT_DIR, "index.html"), "w", encoding = "utf-8", buffering = 1 << 20) as f:
+        template.stream(blocks = html_chunks).dump(f)
 
 if __name__ == "__main__":
-    main()
-
+    asyncio.run(main())